@@ -18,7 +18,7 @@ def logTransitionMatrixPolynomialApproximation (indelParams, alphabetSize, degre
     ms_rmserr = np.sqrt (np.mean ((ms_predicted - ms) ** 2, axis=0))  # (3,3)
     return coeffs, tmin, tmax, ms_rmserr
 
-def piecewiseLinearCountsApproximation (indelParams, alphabetSize, tmax = 10, steps = 100):
+def piecewiseLinearCountsApproximation (indelParams, alphabetSize, tmax = 10, steps = 128):
     _finalCounts, counts, tmin = h20.integrateCounts_RK4(tmax,indelParams,steps=steps)
     return np.concatenate ([h20.initCounts(indelParams)[None,:], counts], axis=0), tmin, tmax, steps
 
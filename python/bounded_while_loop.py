@@ -1,6 +1,8 @@
-# Patrick Kidger's bounded_while_loop
+# Bounded while loop, adapted from Patrick Kidger's bounded_while_loop
 # https://github.com/google/jax/issues/8239#issue-1027850539
 
+import math
+
 import jax
 import jax.lax as lax
 import jax.numpy as jnp
@@ -32,27 +34,29 @@ def bounded_while_loop(cond_fun, body_fun, init_val, max_steps):
         raise ValueError("max_steps must be a non-negative integer")
     if max_steps == 0:
         return init_val
-    if max_steps & (max_steps - 1) != 0:
-        raise ValueError("max_steps must be a power of two")
-
-    init_data = (cond_fun(init_val), init_val)
-    _, val = _while_loop(cond_fun, body_fun, init_data, max_steps)
-    return val
 
-def _while_loop(cond_fun, body_fun, data, max_steps):
-    if max_steps == 1:
+    # Two levels of scan with a step cap: an outer scan over chunks of about sqrt(max_steps) steps, each skipped by a cond once
+    # the loop has exited, so a converged loop pays one trip per remaining chunk rather than one per remaining step.
+    # Unlike lax.while_loop, this remains reverse-mode differentiable.
+    def _step(data, _):
         pred, val = data
-        new_val = body_fun(val)
-        keep = lambda a, b: lax.select(pred, a, b)
-        new_val = jax.tree_util.tree_map(keep, new_val, val)
-        return cond_fun(new_val), new_val
-    else:
+        new_val = lax.cond(pred, body_fun, lambda x: x, val)
+        return (cond_fun(new_val), new_val), None
 
-        def _call(_data):
-            return _while_loop(cond_fun, body_fun, _data, max_steps // 2)
+    def _steps(data, length):
+        # unroll trivially short loops, which would otherwise still be wrapped in an HLO while
+        return lax.scan(_step, data, xs=None, length=length, unroll=length if length <= 2 else 1)[0]
 
-        def _scan_fn(_data, _):
-            _pred, _ = _data
-            return lax.cond(_pred, _call, lambda x: x, _data), None
+    def _chunk(data, _):
+        return lax.cond(data[0], lambda d: _steps(d, chunk_size), lambda d: d, data), None
 
-        return lax.scan(_scan_fn, data, xs=None, length=2)[0]
\ No newline at end of file
+    data = (cond_fun(init_val), init_val)
+    chunk_size = max(1, math.isqrt(max_steps))
+    n_chunks, remainder = divmod(max_steps, chunk_size)
+    if n_chunks > 1:
+        data, _ = lax.scan(_chunk, data, xs=None, length=n_chunks)
+    else:
+        remainder = max_steps
+    if remainder > 0:
+        data = lax.cond(data[0], lambda d: _steps(d, remainder), lambda d: d, data)
+    return data[1]
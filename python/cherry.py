@@ -56,7 +56,7 @@ def pickCherries (parentIndex, distanceToParent):
                 yield (i,j), dij
     return cherryPairs()
 
-def getPosteriorWeights (data, model, alphabetSize=20, useKM03=False):
+def getPosteriorWeights (data, model, alphabetSize=20, useKM03=False, leafLikelihood=None):
     seqs, parentIndex, distanceToParent, transCounts = data
     subRate, rootProb, indelParams, alnTypeWeight, colTypeWeight, colQuantiles = model
     alphabetSize = subRate.shape[-1]
@@ -64,7 +64,7 @@ def getPosteriorWeights (data, model, alphabetSize=20, useKM03=False):
     colTypeLogWeight = jnp.log(colTypeWeight)
     alnTypeLogWeight = jnp.log(alnTypeWeight)
     colMask = jnp.where(jnp.all(seqs < 0, axis=0), 0, 1)  # (nCols,)
-    qtc_ll = likelihood.subLogLike (seqs, distanceToParent, parentIndex, subRate, rootProb)  # (nQuantiles, nColTypes, nCols)
+    qtc_ll = likelihood.subLogLike (seqs, distanceToParent, parentIndex, subRate, rootProb, leafLikelihood=leafLikelihood)  # (nQuantiles, nColTypes, nCols)
     aqtc_ll = qtc_ll[None,...] + colTypeLogWeight[:,None,:,None] - logQuantiles  # (nAlignTypes, nQuantiles, nColTypes, nCols)
     atc_ll = logsumexp(aqtc_ll,axis=1)  # (nAlignTypes, nColTypes, nCols)
     at_ll = jnp.einsum('atc->at', atc_ll)  # (nAlignTypes, nColTypes)
@@ -147,7 +147,7 @@ def getDatasetCounts (dataset, alphabetSize, logBase=defaultLogBase):
         ts, subRateCount, transCount = cherryCountsToArrays (count_by_t)
         yield rootCount, count_by_t, ts, subRateCount, transCount
 
-def getPosteriorCounts (dataset, params, model_factory, getPosteriorWeights=getPosteriorWeights, logBase=defaultLogBase, **kwargs):
+def getPosteriorCounts (dataset, params, model_factory, getPosteriorWeights=getPosteriorWeights, logBase=defaultLogBase, leafLikelihoods=None, **kwargs):
     model = model_factory (params)
     subRate, _rootProb, _indelParams, _alnTypeWeight, colTypeWeight, colQuantiles = model
     nAlignTypes, nColTypes = colTypeWeight.shape
@@ -158,8 +158,10 @@ def getPosteriorCounts (dataset, params, model_factory, getPosteriorWeights=getP
     rootCount = np.zeros ((nQuantiles, nColTypes, alphabetSize))
     count_by_t = {}  # count_by_t[discretizedTime] = (subRateCount, transCounts)
     ll = 0.
-    for data in tqdm(dataset):
-        a_pp, at_c, qtc_pp, a_ll = getPosteriorWeights (data, model, **kwargs)
+    if leafLikelihoods is None:
+        leafLikelihoods = [None] * len(dataset)
+    for data, leafLikelihood in tqdm(list(zip(dataset, leafLikelihoods))):
+        a_pp, at_c, qtc_pp, a_ll = getPosteriorWeights (data, model, leafLikelihood=leafLikelihood, **kwargs)
         a_count += a_pp
         at_count += at_c
         ll += a_ll
@@ -192,7 +194,7 @@ def createCompositeIndelLoss (model_factory, useKM03=False, **kwargs):
         alphabetSize = subRate.shape[-1]
         loss = 0.
         for a in range(nAlignTypes):
-            logTransMat = jnp.log (jnp.stack ([transitionMatrix(t,indelParams[a],alphabetSize=alphabetSize) for t in ts], axis=0))
+            logTransMat = jnp.log (jax.vmap (lambda t: transitionMatrix(t,indelParams[a],alphabetSize=alphabetSize)) (ts))
             loss -= jnp.sum (transCount[:,a,:,:] * logTransMat)
         return loss
     return compositeIndelLoss
@@ -211,10 +213,12 @@ def optimizeByPhyloExpectationCompositeMaximization (dataset, model_factory, par
         getPosteriorWeights_jit = getPosteriorWeights
     sub_loss_value_and_grad = value_and_grad (createCompositeSubLoss (model_factory))
     trans_loss_value_and_grad = value_and_grad (createCompositeIndelLoss (model_factory, useKM03=useKM03))
+    alphabetSize = params['subs'][0]['subrate'].shape[-1]
+    leafLikelihoods = [likelihood.precomputeLeafLikelihood (data[0], alphabetSize) for data in dataset]  # computed once, reused by every E-step
     optax_args = dict((k,v) for k,v in [('init_lr',init_lr),('show_grads',show_grads)] if v is not None)
     def take_step (params, nStep):
         logging.warning("E-step %d: computing posterior counts" % (nStep+1))
-        a_count, at_count, ts, rootCount, subRateCount, transCount, ll = getPosteriorCounts(dataset, params, model_factory, getPosteriorWeights=getPosteriorWeights_jit, useKM03=useKM03)
+        a_count, at_count, ts, rootCount, subRateCount, transCount, ll = getPosteriorCounts(dataset, params, model_factory, getPosteriorWeights=getPosteriorWeights_jit, leafLikelihoods=leafLikelihoods, useKM03=useKM03)
         logging.warning ("M-step %d: optimizing composite likelihoods (actual loss %f)" % (nStep+1, -ll))
         sub_loss_vg_bound = lambda params: sub_loss_value_and_grad (params, ts, rootCount, subRateCount)
         trans_loss_vg_bound = lambda params: trans_loss_value_and_grad (params, ts, transCount)
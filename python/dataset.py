@@ -42,17 +42,24 @@ def loadMultipleTreesAndAlignments (treeDir, alignDir, alphabet, families = None
 def loadTreeFamData (treeFamDir, alphabet, **kwargs):
     return loadMultipleTreesAndAlignments (treeFamDir, treeFamDir, alphabet, **kwargs)
 
-def createLossFunction (dataset, model_factory, includeSubs = True, includeIndels = True, useKM03 = False):
+def createLossFunction (dataset, model_factory, includeSubs = True, includeIndels = True, useKM03 = False, discretizationParams = None, useEig = False):
     def loss (params):
         subRate, rootProb, indelParams, alnTypeWeight, colTypeWeight, colQuantiles = model_factory (params)
         alphabetSize = subRate.shape[-1]
         logQuantiles = jnp.log(len(colQuantiles))
         colTypeLogWeight = jnp.log(colTypeWeight)
         alnTypeLogWeight = jnp.log(alnTypeWeight)
+        if discretizationParams is not None:
+            if useEig:
+                discreteTimeSubMatrix = likelihood.computeSubMatrixForDiscretizedTimesEig (subRate, rootProb, discretizationParams)  # computed once, shared by all trees
+            else:
+                discreteTimeSubMatrix = likelihood.computeSubMatrixForDiscretizedTimes (subRate, discretizationParams)  # computed once, shared by all trees
+        else:
+            discreteTimeSubMatrix = None
         l_total = 0.
         for seqs, parentIndex, distanceToParent, transCounts in dataset:
             if includeSubs:
-                sub_ll = likelihood.subLogLike (seqs, distanceToParent, parentIndex, subRate, rootProb)  # (nQuantiles, nColTypes, nCols)
+                sub_ll = likelihood.subLogLike (seqs, distanceToParent, parentIndex, subRate, rootProb, reversible=useEig, discreteTimeSubMatrix=discreteTimeSubMatrix, discretizationParams=discretizationParams)  # (nQuantiles, nColTypes, nCols)
                 sub_ll = jnp.sum(sub_ll,axis=-1)  # (nQuantiles, nColTypes)
                 sub_ll = logsumexp(sub_ll,axis=0) - logQuantiles  # (nColTypes,)
                 sub_ll = colTypeLogWeight + sub_ll[None,:]  # (nAlignTypes, nColTypes)
@@ -1,6 +1,9 @@
+import numpy as np
 import jax
 import jax.numpy as jnp
-from jax.scipy.linalg import expm
+
+from functools import partial
+from jax import jit
 
 from tensorflow_probability.substrates.jax.distributions import Gamma
 
@@ -26,9 +29,21 @@ def treeIsValid (distanceToParent, parentIndex, alignmentRows):
 # To pad rows, set parentIndex[paddingRow:] = arange(paddingRow,R)
 # To pad columns, set alignment[paddingRow,paddingCol:] = -1
 
-def subLogLike (alignment, distanceToParent, parentIndex, subRate, rootProb):
-    subMatrix = computeSubMatrixForTimes (distanceToParent, subRate)
-    return subLogLikeForMatrices (alignment, parentIndex, subMatrix, rootProb)
+# If reversible is True, subRate must satisfy detailed balance with respect to rootProb (e.g. as returned by parametricReversibleSubModel)
+# If discreteTimeSubMatrix is given (from computeSubMatrixForDiscretizedTimes), branch lengths are rounded to the discretized times and their matrices looked up
+# If leafLikelihood is given (from precomputeLeafLikelihood), alignment is ignored and may be None
+
+@partial(jit, static_argnames=('reversible','discretizationParams'))
+def subLogLike (alignment, distanceToParent, parentIndex, subRate, rootProb, reversible = False, discreteTimeSubMatrix = None, discretizationParams = None, leafLikelihood = None):
+    if discreteTimeSubMatrix is not None:
+        subMatrix = computeSubMatrixForDiscretizedBranchLengths (distanceToParent, discreteTimeSubMatrix, discretizationParams or defaultDiscretizationParams)
+    elif reversible:
+        subMatrix = computeSubMatrixForTimesEig (distanceToParent, subRate, rootProb)
+    else:
+        subMatrix = computeSubMatrixForTimes (distanceToParent, subRate)
+    if leafLikelihood is None:
+        return subLogLikeForMatrices (alignment, parentIndex, subMatrix, rootProb)
+    return subLogLikeForLeafLikelihood (leafLikelihood, parentIndex, subMatrix, rootProb)
 
 def transLogLike (transCounts, distanceToParent, indelParams, alphabetSize = 20, useKM03 = False):
     nRows = distanceToParent.shape[0]
@@ -43,9 +58,116 @@ def computeSubMatrixForTimes (distanceToParent, subRate):
     *H, A = subRate.shape[0:-1]
     assert subRate.shape == (*H,A,A)
     # Compute transition matrices per branch
-    subMatrix = expm (jnp.einsum('...ij,r->...rij', subRate, distanceToParent))  # (*H,R,A,A)
+    subMatrix = batchedExpm (subRate[...,None,:,:] * distanceToParent[:,None,None])  # (*H,R,A,A)
     return subMatrix
 
+# Matrix exponential for a batch of small matrices, by scaling and squaring with a fixed degree-13 Pade approximant (Higham, 2005)
+# jax.scipy.linalg.expm vectorizes over the batch, which evaluates every Pade degree and the maximum number of squarings for every matrix.
+# Here each step is a single batched matmul, and squarings stop once the most-scaled matrix in the batch is done.
+padeCoeffs13 = (64764752532480000., 32382376266240000., 7771770303897600., 1187353796428800., 129060195264000., 10559470521600.,
+                670442572800., 33522128640., 1323241920., 40840800., 960960., 16380., 182., 1.)
+padeMaxNorm13 = 5.371920351148152
+
+def batchedExpm (matrix, maxSquarings = 16):
+    *B, A = matrix.shape[0:-1]
+    assert matrix.shape == (*B,A,A)
+    b = padeCoeffs13
+    norm = jax.lax.stop_gradient (jnp.max (jnp.sum (jnp.abs(matrix), axis=-2), axis=-1))  # (*B,) L1 norm
+    rawSquarings = jnp.ceil (jnp.log2 (norm / padeMaxNorm13))  # (*B,)
+    nSquarings = jnp.clip (rawSquarings, 0, maxSquarings)
+    X = matrix / (2 ** nSquarings)[...,None,None]
+    I = jnp.eye (A, dtype=matrix.dtype)
+    X2 = X @ X
+    X4 = X2 @ X2
+    X6 = X4 @ X2
+    U = X @ (X6 @ (b[13]*X6 + b[11]*X4 + b[9]*X2) + b[7]*X6 + b[5]*X4 + b[3]*X2 + b[1]*I)
+    V = X6 @ (b[12]*X6 + b[10]*X4 + b[8]*X2) + b[6]*X6 + b[4]*X4 + b[2]*X2 + b[0]*I
+    R = jnp.linalg.solve (V - U, V + U)
+    maxNSquarings = jnp.max (nSquarings)
+    def square (R, i):
+        return jax.lax.cond (i < maxNSquarings,
+                             lambda R: jnp.where ((i < nSquarings)[...,None,None], R @ R, R),
+                             lambda R: R, R), None
+    R, _dummy = jax.lax.scan (square, R, jnp.arange(maxSquarings))
+    # like jax.scipy.linalg.expm, return NaN rather than a silently wrong result when maxSquarings is not enough
+    return jnp.where ((rawSquarings > maxSquarings)[...,None,None], jnp.nan, R)
+
+# Reversible rate matrices are symmetric after a diagonal similarity transform, so one eigendecomposition serves all branches
+# It is opt-in (subLogLike's reversible flag, createLossFunction's useEig): the kernel is much faster than batchedExpm,
+# but its float32 error is larger (about 6e-7 vs 1e-7 absolute on LG08), and full-loss time is dominated by pruning anyway
+def computeSubMatrixForTimesEig (distanceToParent, subRate, rootProb):
+    assert distanceToParent.ndim == 1
+    assert subRate.ndim >= 2
+    R, = distanceToParent.shape
+    *H, A = subRate.shape[0:-1]
+    assert subRate.shape == (*H,A,A)
+    assert rootProb.shape == (*H,A)
+    sqrtRootProb = jnp.sqrt(rootProb)  # (*H,A)
+    symRate = jnp.einsum('...i,...ij,...j->...ij', sqrtRootProb, subRate, 1/sqrtRootProb)  # (*H,A,A)
+    symRate = 0.5 * (symRate + symRate.swapaxes(-1,-2))  # remove rounding asymmetry
+    symMatrix = symmetricExpmForTimes (symRate, distanceToParent)  # (*H,R,A,A)
+    subMatrix = jnp.einsum('...i,...rij,...j->...rij', 1/sqrtRootProb, symMatrix, sqrtRootProb)  # (*H,R,A,A)
+    return jnp.maximum (subMatrix, 0)  # eigendecomposition rounding can leave tiny negative probabilities
+
+# expm(t*symRate) for each t, via eigh. Differentiating through eigh gives NaN gradients when eigenvalues are repeated
+# (e.g. Jukes-Cantor), so the JVP is given directly by the Daleckii-Krein formula, which uses divided differences of exp(t*lambda)
+@jax.custom_jvp
+def symmetricExpmForTimes (symRate, ts):
+    eigval, eigvec = jnp.linalg.eigh (symRate)  # (*H,A), (*H,A,A)
+    expEigval = jnp.exp (eigval[...,None,:] * ts[:,None])  # (*H,R,A)
+    return jnp.einsum('...ik,...rk,...jk->...rij', eigvec, expEigval, eigvec)  # (*H,R,A,A)
+
+@symmetricExpmForTimes.defjvp
+def symmetricExpmForTimesJvp (primals, tangents):
+    symRate, ts = primals
+    dSymRate, dts = tangents
+    eigval, eigvec = jnp.linalg.eigh (symRate)  # (*H,A), (*H,A,A)
+    expEigval = jnp.exp (eigval[...,None,:] * ts[:,None])  # (*H,R,A)
+    out = jnp.einsum('...ik,...rk,...jk->...rij', eigvec, expEigval, eigvec)
+    # divided differences (exp(t*l_k)-exp(t*l_l))/(l_k-l_l) = t*exp(t*max(l_k,l_l))*exprel(-t*|l_k-l_l|), which is t*exp(t*l_k) when l_k=l_l
+    maxEigval = jnp.maximum (eigval[...,:,None], eigval[...,None,:])  # (*H,A,A)
+    x = -ts[:,None,None] * jnp.abs (eigval[...,:,None] - eigval[...,None,:])[...,None,:,:]  # (*H,R,A,A)
+    small = x > -1e-3
+    safeX = jnp.where (small, -1., x)
+    exprel = jnp.where (small, 1. + x/2 + x*x/6, jnp.expm1(safeX) / safeX)
+    divDiff = ts[:,None,None] * jnp.exp (ts[:,None,None] * maxEigval[...,None,:,:]) * exprel  # (*H,R,A,A)
+    dRotated = jnp.einsum('...ik,...ij,...jl->...kl', eigvec, dSymRate, eigvec)  # (*H,A,A)
+    dOut = jnp.einsum('...ik,...rkl,...jl->...rij', eigvec, divDiff * dRotated[...,None,:,:], eigvec)
+    dOut = dOut + jnp.einsum('...ik,...rk,...jk->...rij', eigvec, eigval[...,None,:] * expEigval * dts[:,None], eigvec)
+    return out, dOut
+
+# Branch lengths can be discretized to a geometric grid of times, so that substitution matrices are computed once per grid point rather than once per branch
+# discretizationParams = (tMin, tMax, nSteps)
+# Each branch uses the nearest grid time, clamped to [tMin,tMax]: e.g. a branch of length 20 is treated as length tMax=10,
+# which changes both the likelihood and its gradient with respect to the rates. Zero-length branches use the identity.
+defaultDiscretizationParams = (1e-3, 10., 128)
+
+def discretizedTimes (discretizationParams = defaultDiscretizationParams):
+    tMin, tMax, nSteps = discretizationParams
+    return jnp.geomspace (tMin, tMax, num=nSteps)  # (T,)
+
+def computeSubMatrixForDiscretizedTimes (subRate, discretizationParams = defaultDiscretizationParams):
+    return computeSubMatrixForTimes (discretizedTimes(discretizationParams), subRate)  # (*H,T,A,A)
+
+def computeSubMatrixForDiscretizedTimesEig (subRate, rootProb, discretizationParams = defaultDiscretizationParams):
+    return computeSubMatrixForTimesEig (discretizedTimes(discretizationParams), subRate, rootProb)  # (*H,T,A,A)
+
+def discretizeBranchLengths (distanceToParent, discretizationParams = defaultDiscretizationParams):
+    tMin, tMax, nSteps = discretizationParams
+    logRatio = jnp.log(tMax / tMin) / (nSteps - 1)
+    index = jnp.round (jnp.log (jnp.maximum (distanceToParent, tMin) / tMin) / logRatio)
+    # lengths outside [tMin,tMax] are clamped to the end of the grid
+    return jnp.clip (index, 0, nSteps - 1).astype(jnp.int32)  # (R,)
+
+def computeSubMatrixForDiscretizedBranchLengths (distanceToParent, discreteTimeSubMatrix, discretizationParams = defaultDiscretizationParams):
+    assert distanceToParent.ndim == 1
+    *H, T, A = discreteTimeSubMatrix.shape[0:-1]
+    assert discreteTimeSubMatrix.shape == (*H,T,A,A)
+    assert T == discretizationParams[2]
+    subMatrix = jnp.take (discreteTimeSubMatrix, discretizeBranchLengths(distanceToParent,discretizationParams), axis=-3)  # (*H,R,A,A)
+    # zero-length branches get the identity matrix rather than the shortest discretized time
+    return jnp.where (distanceToParent[:,None,None] > 0, subMatrix, jnp.eye(A))
+
 def logTransMat (transMat):
     return jnp.log (jnp.maximum (transMat, h20.smallest_float32))
 
@@ -54,7 +176,7 @@ def logRootTransMat():
 
 def computeTransMatForTimes (ts, indelParams, alphabetSize=20, useKM03=False):
     transitionMatrix = km03.transitionMatrix if useKM03 else h20.transitionMatrix
-    branches = jnp.stack ([transitionMatrix(t,indelParams,alphabetSize=alphabetSize) for t in ts[1:]], axis=0)
+    branches = jax.vmap (lambda t: transitionMatrix(t,indelParams,alphabetSize=alphabetSize)) (ts[1:])
     return jnp.concatenate ([logRootTransMat()[None,:,:], logTransMat(branches)], axis=0)
 
 def transLogLikeForTransMats (transCounts, transMats):
@@ -64,43 +186,59 @@ def transLogLikeForTransMats (transCounts, transMats):
     trans_ll = jnp.sum (trans_ll, axis=(-1,-2))
     return trans_ll  # (...categories...,rows)
 
-def subLogLikeForMatrices (alignment, parentIndex, subMatrix, rootProb, maxChunkSize = 128):
+# Leaf likelihoods depend only on the alignment, so callers evaluating the same alignment repeatedly (e.g. during training) can compute them once
+def precomputeLeafLikelihood (alignment, alphabetSize, dtype = jnp.float32):
     assert alignment.ndim == 2
+    assert alignment.dtype == jnp.int32
+    A = alphabetSize
+    tokenLookup = jnp.concatenate([jnp.ones((1,A),dtype=dtype),jnp.eye(A,dtype=dtype)], axis=0)
+    return tokenLookup[alignment + 1]  # (R,C,A)
+
+@partial(jit, static_argnames=('maxChunkSize',))
+def subLogLikeForMatrices (alignment, parentIndex, subMatrix, rootProb, maxChunkSize = 128):
+    leafLikelihood = precomputeLeafLikelihood (alignment, subMatrix.shape[-1], dtype=subMatrix.dtype)
+    return subLogLikeForLeafLikelihood (leafLikelihood, parentIndex, subMatrix, rootProb, maxChunkSize=maxChunkSize)
+
+@partial(jit, static_argnames=('maxChunkSize',))
+def subLogLikeForLeafLikelihood (leafLikelihood, parentIndex, subMatrix, rootProb, maxChunkSize = 128):
+    assert leafLikelihood.ndim == 3
     assert subMatrix.ndim >= 3
     *H, R, A = subMatrix.shape[0:-1]
-    C = alignment.shape[-1]
+    C = leafLikelihood.shape[-2]
+    assert leafLikelihood.shape == (R,C,A)
     assert parentIndex.shape == (R,)
     assert rootProb.shape == (*H,A)
     assert subMatrix.shape == (*H,R,A,A)
-    assert alignment.dtype == jnp.int32
     assert parentIndex.dtype == jnp.int32
     # If too big, split into chunks
     if C > maxChunkSize:
 #        jax.debug.print('Splitting %d x %d alignment into %d chunks of size %d x %d' % (R,C,C//maxChunkSize,R,maxChunkSize))
-        return jnp.concatenate ([subLogLikeForMatrices (alignment[:,i:i+maxChunkSize], parentIndex, subMatrix, rootProb) for i in range(0,C,maxChunkSize)], axis=-1)
+        return jnp.concatenate ([subLogLikeForLeafLikelihood (leafLikelihood[:,i:i+maxChunkSize,:], parentIndex, subMatrix, rootProb) for i in range(0,C,maxChunkSize)], axis=-1)
     # Initialize pruning matrix
-    tokenLookup = jnp.concatenate([jnp.ones(A)[None,:],jnp.eye(A)])
-    likelihood = tokenLookup[alignment + 1]  # (R,C,A)
+    likelihood = leafLikelihood.astype (subMatrix.dtype)  # (R,C,A)
+    # The scan carry needs the H axes for internal nodes, so broadcast rather than add a zero tensor
     if len(H) > 0:
-        likelihood += jnp.zeros((*H,R,C,A))
-    logNorm = jnp.zeros((*H,C))  # (*H,C)
+        likelihood = jnp.broadcast_to (likelihood, (*H,R,C,A))
+    logNorm = jnp.zeros((*H,C), dtype=subMatrix.dtype)  # (*H,C)
     # Compute log-likelihood for all columns in parallel by iterating over nodes in postorder
-    postorderBranches = (jnp.arange(R-1,0,-1),  # child indices
-                         jnp.flip(parentIndex[1:]), # parent indices
-                         jnp.flip(jnp.moveaxis(subMatrix,-3,0)[1:,...],axis=0))  # substitution matrices
-    (likelihood, logNorm), _dummy = jax.lax.scan (computeLogLikeForBranch, (likelihood, logNorm), postorderBranches)
+    # The scan body is compiled once, so compile time does not grow with the number of rows
+    def computeLogLikeForBranch (vars, child):
+        likelihood, logNorm = vars
+        parent = parentIndex[child]
+        # Update the parent slice with plain multiplies, then write it back with a single in-place update
+        parentLike = likelihood[...,parent,:,:] * jnp.einsum('...ij,...cj->...ci', subMatrix[...,child,:,:], likelihood[...,child,:,:])  # (*H,C,A)
+        # Likelihoods are stored scaled by their maximum, with the log scale accumulated in logNorm.
+        # This is a logsumexp with the max factored out, so the product with subMatrix stays a matmul.
+        maxLike = jnp.max(parentLike, axis=-1)  # (*H,C)
+        safeMaxLike = jnp.where (maxLike > 0., maxLike, 1.)  # impossible columns give -inf rather than NaN
+        likelihood = likelihood.at[...,parent,:,:].set (parentLike / safeMaxLike[...,None])  # guard against underflow
+        logNorm = logNorm + jnp.log(maxLike)
+        return (likelihood, logNorm), None
+    postorderChildren = jnp.arange(R-1,0,-1)
+    (likelihood, logNorm), _dummy = jax.lax.scan (computeLogLikeForBranch, (likelihood, logNorm), postorderChildren)
     logNorm = logNorm + jnp.log(jnp.einsum('...ci,...i->...c', likelihood[...,0,:,:], rootProb))  # (*H,C)
     return logNorm
 
-def computeLogLikeForBranch (vars, branch):
-    likelihood, logNorm = vars
-    child, parent, subMatrix = branch
-    likelihood = likelihood.at[...,parent,:,:].multiply (jnp.einsum('...ij,...cj->...ci', subMatrix, likelihood[...,child,:,:]))
-    maxLike = jnp.max(likelihood[...,parent,:,:], axis=-1)  # (*H,C)
-    likelihood = likelihood.at[...,parent,:,:].divide (maxLike[...,None])  # guard against underflow
-    logNorm = logNorm + jnp.log(maxLike)
-    return (likelihood, logNorm), None
-
 def padDimension (len, multiplier):
     return jnp.where (multiplier == 2,  # handle this case specially to avoid precision errors
                       1 << (len-1).bit_length(),
@@ -195,8 +333,15 @@ def createGGIModelFactory (subModelFactory, nQuantiles):
 def parseHistorianParams (params):
     alphabet = params['alphabet']
     def parseSubRate (p):
-        subRate = jnp.array([[p['subrate'].get(i,{}).get(j,0) for j in alphabet] for i in alphabet], dtype=jnp.float32)
-        rootProb = jnp.array([p['rootprob'].get(i,0) for i in alphabet], dtype=jnp.float32)
+        # build constant arrays in NumPy and convert once, rather than passing nested lists through JAX
+        subRate = np.zeros ((len(alphabet),len(alphabet)), dtype=np.float32)
+        rootProb = np.zeros (len(alphabet), dtype=np.float32)
+        for i, ai in enumerate(alphabet):
+            row = p['subrate'].get(ai,{})
+            for j, aj in enumerate(alphabet):
+                subRate[i,j] = row.get(aj,0)
+            rootProb[i] = p['rootprob'].get(ai,0)
+        subRate, rootProb = jnp.asarray(subRate), jnp.asarray(rootProb)
         subRate, rootProb = normalizeSubModel (subRate, rootProb)
         return subRate, rootProb
     if 'mixture' in params or 'coltype' in params:
@@ -0,0 +1,177 @@
+import unittest
+
+import numpy as np
+import scipy.linalg
+
+import jax
+import jax.experimental
+import jax.numpy as jnp
+from jax.scipy.linalg import expm
+
+import likelihood
+import h20
+
+jax.config.update('jax_platform_name', 'cpu')
+
+# Tests for the substitution and indel likelihood kernels, checked against reference implementations
+def randomReversibleParams (rng, A = 4):
+    exchangeRate = rng.uniform (0.5, 1.5, (A,A))
+    rootLogits = rng.normal (size=(A,))
+    return jnp.array (exchangeRate), jnp.array (rootLogits)
+
+def jukesCantorParams (A = 4):
+    return jnp.ones ((A,A)), jnp.zeros ((A,))
+
+def referenceSubMatrixForTimes (distanceToParent, subRate):
+    return jnp.stack ([expm (subRate * t) for t in distanceToParent], axis=0)
+
+class TestLikelihood (unittest.TestCase):
+
+    # MATRIX EXPONENTIAL
+
+    # batchedExpm should agree with scipy for rate matrices over a wide range of norms, including the zero matrix
+    def test_batchedExpm_value (self):
+        rng = np.random.default_rng (1)
+        for scale in [0., 1e-3, 1., 10., 100., 1000.]:
+            subRate, _rootProb = likelihood.parametricSubModel (jnp.array (rng.uniform (0, 1, (5,5))), jnp.array (rng.normal (size=(5,))))
+            matrix = scale * subRate
+            expected = scipy.linalg.expm (np.asarray (matrix, dtype=np.float64))
+            actual = likelihood.batchedExpm (matrix[None,:,:])[0]
+            self.assertTrue (jnp.allclose (actual, expected, rtol=1e-4, atol=1e-5), f"scale={scale}")
+        # Norms needing more than maxSquarings squarings give NaN, as jax.scipy.linalg.expm does, rather than inf or 0
+        for scale in [1e7, 1e8]:
+            matrix = scale * subRate
+            self.assertTrue (jnp.all (jnp.isnan (expm (matrix))))
+            actual = likelihood.batchedExpm (jnp.stack ([matrix, subRate]))
+            self.assertTrue (jnp.all (jnp.isnan (actual[0])), f"scale={scale}")
+            self.assertTrue (jnp.allclose (actual[1], scipy.linalg.expm (np.asarray (subRate, dtype=np.float64)), rtol=1e-4, atol=1e-5))
+
+    def test_batchedExpm_zero (self):
+        actual = likelihood.batchedExpm (jnp.zeros ((3,4,4)))
+        self.assertTrue (jnp.array_equal (actual, jnp.broadcast_to (jnp.eye (4), (3,4,4))))
+
+    # The gradient of batchedExpm should match that of jax.scipy.linalg.expm
+    def test_batchedExpm_gradient (self):
+        rng = np.random.default_rng (2)
+        subRate, _rootProb = likelihood.parametricSubModel (jnp.array (rng.uniform (0, 1, (4,4))), jnp.array (rng.normal (size=(4,))))
+        weights = jnp.array (rng.normal (size=(4,4)))
+        for scale in [0.1, 1., 20.]:
+            f = lambda m: jnp.sum (weights * likelihood.batchedExpm (m[None,:,:])[0])
+            g = lambda m: jnp.sum (weights * expm (m))
+            self.assertTrue (jnp.allclose (jax.grad(f) (scale * subRate), jax.grad(g) (scale * subRate), rtol=1e-3, atol=1e-4), f"scale={scale}")
+
+    # EIGENDECOMPOSITION PATH (reversible models)
+
+    def test_eig_value (self):
+        self.do_test_eig_value (*randomReversibleParams (np.random.default_rng (3)))
+
+    def test_eig_value_jukesCantor (self):
+        self.do_test_eig_value (*jukesCantorParams())
+
+    def do_test_eig_value (self, exchangeRate, rootLogits):
+        subRate, rootProb = likelihood.parametricReversibleSubModel (exchangeRate, rootLogits)
+        ts = jnp.array ([0., 0.01, 0.3, 1., 5.])
+        expected = referenceSubMatrixForTimes (ts, subRate)
+        actual = likelihood.computeSubMatrixForTimesEig (ts, subRate, rootProb)
+        self.assertTrue (jnp.allclose (actual, expected, rtol=1e-4, atol=1e-5))
+
+    # Gradients through the eig path should be finite and match expm, even when eigenvalues are repeated
+    def test_eig_gradient (self):
+        self.do_test_eig_gradient (*randomReversibleParams (np.random.default_rng (4)))
+
+    def test_eig_gradient_jukesCantor (self):
+        self.do_test_eig_gradient (*jukesCantorParams())
+
+    def do_test_eig_gradient (self, exchangeRate, rootLogits):
+        ts = jnp.array ([0.05, 0.5, 2.])
+        weights = jnp.array (np.random.default_rng (5).normal (size=(len(ts),) + exchangeRate.shape))
+        def eigLoss (exchangeRate, rootLogits):
+            subRate, rootProb = likelihood.parametricReversibleSubModel (exchangeRate, rootLogits)
+            return jnp.sum (weights * likelihood.computeSubMatrixForTimesEig (ts, subRate, rootProb))
+        def expmLoss (exchangeRate, rootLogits):
+            subRate, _rootProb = likelihood.parametricReversibleSubModel (exchangeRate, rootLogits)
+            return jnp.sum (weights * referenceSubMatrixForTimes (ts, subRate))
+        actual = jax.grad (eigLoss, argnums=(0,1)) (exchangeRate, rootLogits)
+        expected = jax.grad (expmLoss, argnums=(0,1)) (exchangeRate, rootLogits)
+        for a, e in zip (actual, expected):
+            self.assertTrue (jnp.all (jnp.isfinite (a)))
+            self.assertTrue (jnp.allclose (a, e, rtol=1e-3, atol=1e-4))
+
+    # INDEL TRANSITION MATRICES
+
+    # transitionMatrixForTimes should agree with mapping transitionMatrix over the branches, across the zero/short/long partition
+    def test_transitionMatrixForTimes (self):
+        indelParams = jnp.array ([0.05, 0.055, 0.7, 0.7])
+        ts = jnp.array ([0., 0.001, 0.1, 1., 3., 50., 500.])
+        expected = jax.vmap (lambda t: h20.transitionMatrix (t, indelParams)) (ts)
+        actual = h20.transitionMatrixForTimes (ts, indelParams)
+        self.assertTrue (jnp.allclose (actual, expected, rtol=1e-4, atol=1e-6))
+
+    # integrateCounts should match a tight float64 diffrax solution at short branch lengths, where float32 rounding in
+    # the counts is amplified by transitionMatrixFromCounts
+    def test_integrateCounts_shortTimes (self):
+        indelParams = jnp.array ([0.01, 0.01, 0.66, 0.66])
+        ts = np.logspace (np.log10 (h20.tMin), -1, 9)
+        with jax.experimental.enable_x64():
+            indelParams64 = jnp.array (indelParams, dtype=jnp.float64)
+            expectedCounts = [h20.integrateCounts_diffrax (jnp.float64(t), indelParams64, rtol=1e-10, atol=1e-12, max_steps=100000)[0] for t in ts]
+            expected = [np.asarray (h20.transitionMatrixFromCounts (t, indelParams64, c, h20.lm(t,indelParams64[0],indelParams64[2]), h20.lm(t,indelParams64[1],indelParams64[3]), norm=False))
+                        for t, c in zip (ts, expectedCounts)]
+            expectedCounts = [np.asarray (c) for c in expectedCounts]
+        for t, ec, e in zip (ts, expectedCounts, expected):
+            counts, _counts_by_t, _ts = h20.integrateCounts (jnp.float32(t), indelParams)
+            self.assertTrue (np.allclose (counts, ec, rtol=0, atol=2e-6), f"t={t}")
+            actual = h20.transitionMatrixFromCounts (t, indelParams, counts, h20.lm(t,indelParams[0],indelParams[2]), h20.lm(t,indelParams[1],indelParams[3]), norm=False)
+            self.assertTrue (np.allclose (actual, e, rtol=0, atol=2.5e-3), f"t={t}")
+
+    # PRUNING
+
+    # Passing precomputed leaf likelihoods should give the same log-likelihood as passing the alignment
+    def test_subLogLike_leafLikelihood (self):
+        rng = np.random.default_rng (6)
+        A, C = 4, 7
+        parentIndex = jnp.array ([-1, 0, 0, 1, 1])
+        distanceToParent = jnp.array ([0., 0.2, 0.5, 0.1, 0.3])
+        alignment = jnp.array (rng.integers (0, A, (5,C)), dtype=jnp.int32)
+        alignment = alignment.at[0:2].set (-1).at[3,0].set (-1)  # internal nodes and one gapped leaf cell are wildcards
+        subRate, rootProb = likelihood.parametricSubModel (jnp.array (rng.uniform (0, 1, (A,A))), jnp.array (rng.normal (size=(A,))))
+        expected = likelihood.subLogLike (alignment, distanceToParent, parentIndex, subRate, rootProb)
+        leafLikelihood = likelihood.precomputeLeafLikelihood (alignment, A)
+        actual = likelihood.subLogLike (None, distanceToParent, parentIndex, subRate, rootProb, leafLikelihood=leafLikelihood)
+        self.assertEqual (actual.shape, (C,))
+        self.assertTrue (jnp.allclose (actual, expected, rtol=1e-5, atol=1e-5))
+
+    # DISCRETIZED BRANCH LENGTHS
+
+    # For branch lengths on the grid (and zero-length branches), the discretized path should match the continuous path,
+    # in value and in gradient with respect to the rates
+    def test_subLogLike_discretized (self):
+        rng = np.random.default_rng (7)
+        A, C = 4, 7
+        grid = likelihood.discretizedTimes()
+        parentIndex = jnp.array ([-1, 0, 0, 1, 1, 2])
+        distanceToParent = jnp.array ([0., grid[0], grid[40], 0., grid[90], grid[-1]])
+        alignment = jnp.array (rng.integers (0, A, (6,C)), dtype=jnp.int32)
+        alignment = alignment.at[0:3].set (-1)
+        exchangeRate, rootLogits = randomReversibleParams (rng, A)
+        def loss (exchangeRate, discretized):
+            subRate, rootProb = likelihood.parametricReversibleSubModel (exchangeRate, rootLogits)
+            discreteTimeSubMatrix = likelihood.computeSubMatrixForDiscretizedTimes (subRate) if discretized else None
+            return jnp.sum (likelihood.subLogLike (alignment, distanceToParent, parentIndex, subRate, rootProb, discreteTimeSubMatrix=discreteTimeSubMatrix))
+        expected, expectedGrad = jax.value_and_grad (loss) (exchangeRate, False)
+        actual, actualGrad = jax.value_and_grad (loss) (exchangeRate, True)
+        self.assertTrue (jnp.allclose (actual, expected, rtol=1e-5))
+        self.assertTrue (jnp.allclose (actualGrad, expectedGrad, rtol=1e-3, atol=1e-4))
+
+    # Lengths are rounded to the nearest grid time and clamped to [tMin,tMax]
+    def test_discretizeBranchLengths (self):
+        tMin, tMax, nSteps = likelihood.defaultDiscretizationParams
+        grid = likelihood.discretizedTimes()
+        index = likelihood.discretizeBranchLengths (jnp.array ([0., tMin/10, grid[5]*1.01, grid[6]*0.99, tMax, 2*tMax]))
+        self.assertEqual (index.tolist(), [0, 0, 5, 6, nSteps-1, nSteps-1])
+        subMatrix = likelihood.computeSubMatrixForDiscretizedBranchLengths (jnp.array ([0., 2*tMax]), jnp.ones ((nSteps,3,3)))
+        self.assertTrue (jnp.array_equal (subMatrix[0], jnp.eye (3)))
+        self.assertTrue (jnp.array_equal (subMatrix[1], jnp.ones ((3,3))))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -38,7 +38,11 @@ def main (modelFilename: str,
     subll = likelihood.subLogLike (seqs, distanceToParent, parentIndex, subRate, rootProb)
     subll_total = float (jnp.sum (subll))
 
-    transMat = jnp.stack ([h20.dummyRootTransitionMatrix()] + [h20.transitionMatrix(t,indelParams,alphabetSize=len(alphabet)) for t in distanceToParent[1:]], axis=0)
+    branchTransMat = h20.transitionMatrixForTimes (distanceToParent[1:], indelParams, alphabetSize=len(alphabet), norm=False)
+    # normalize all branches in one reduction (the dummy root matrix is deliberately not normalized)
+    branchTransMat = jnp.maximum (0, branchTransMat)
+    branchTransMat = branchTransMat / jnp.sum (branchTransMat, axis=-1, keepdims=True)
+    transMat = jnp.concatenate ([h20.dummyRootTransitionMatrix()[None,:,:], branchTransMat], axis=0)
     transMat = jnp.log (jnp.maximum (transMat, h20.smallest_float32))
     transll = transCounts * transMat
     transll_total = float (jnp.sum (transll))
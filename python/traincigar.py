@@ -23,6 +23,7 @@ def main (modelFile: str,
           familiesFile: str = None,
           limitFamilies: int = None,
           reversible: bool = False,
+          eig: bool = False,
           km03: bool = False,
           omitIndels: bool = False,
           omitSubs: bool = False,
@@ -48,6 +49,7 @@ def main (modelFile: str,
         familiesFile: File with list of families, one per line
         limitFamilies: Limit number of families
         reversible: Use reversible model
+        eig: Use eigendecomposition instead of matrix exponential for substitution matrices (requires reversible; faster kernel, larger float32 error)
         km03: Use Knudsen-Miyamoto (2003) approximation to GGI model, rather than Holmes (2020)
         train: Train model
         init_lr: Initial learning rate
@@ -89,9 +91,11 @@ def main (modelFile: str,
         raise ValueError ('Either dataDir, or both treeFile and alignFile, must be specified')
 
     # Create loss function
+    if eig and not reversible:
+        raise ValueError ('eig requires a reversible model')
     sub_model_factory = likelihood.parametricReversibleSubModel if reversible else likelihood.parametricSubModel
     ggi_model_factory = likelihood.createGGIModelFactory (sub_model_factory, nQuantiles)
-    loss = dataset.createLossFunction (data, ggi_model_factory, includeSubs=not omitSubs, includeIndels=not omitIndels, useKM03=km03)
+    loss = dataset.createLossFunction (data, ggi_model_factory, includeSubs=not omitSubs, includeIndels=not omitIndels, useKM03=km03, useEig=eig)
 
     jit = jax.jit if use_jit else lambda f: f
 